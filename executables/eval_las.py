@@ -7,7 +7,7 @@ import sys
 from collections import defaultdict
 from sonosco.models.seq2seq_las import Seq2Seq
 from sonosco.common.constants import SONOSCO
-from sonosco.common.utils import setup_logging
+from sonosco.common.utils import setup_logging, labels_to_dict
 from sonosco.common.path_utils import parse_yaml
 from sonosco.training import ModelTrainer
 from sonosco.datasets import create_data_loaders
@@ -34,10 +34,11 @@ def main(config_path):
     device = torch.device("cuda" if CUDA_ENABLED else "cpu")
 
     char_list = config["labels"] + EOS + SOS
+    label_to_id = labels_to_dict(char_list)
 
     config["decoder"]["vocab_size"] = len(char_list)
-    config["decoder"]["sos_id"] = char_list.index(SOS)
-    config["decoder"]["eos_id"] = char_list.index(EOS)
+    config["decoder"]["sos_id"] = label_to_id[SOS]
+    config["decoder"]["eos_id"] = label_to_id[EOS]
 
     # Create mode
     if not config.get('checkpoint_path'):
@@ -10,9 +10,8 @@ from sonosco.decoders import GreedyDecoder
 from sonosco.training.evaluator import ModelEvaluator
 from sonosco.models import DeepSpeech2
 from sonosco.common.global_settings import CUDA_ENABLED
-from torch.utils.data import RandomSampler
 from sonosco.datasets.processor import AudioDataProcessor
-from sonosco.datasets.loader import AudioDataLoader
+from sonosco.datasets.loader import AudioDataLoader, data_loader_worker_kwargs
 from sonosco.datasets.dataset import AudioDataset
 
 LOGGER = logging.getLogger(SONOSCO)
@@ -32,9 +31,8 @@ def evaluate_deepspeech():
 
     processor = AudioDataProcessor(**config)
     test_dataset = AudioDataset(processor, manifest_filepath=config["test_manifest"])
-    sampler = RandomSampler(data_source=test_dataset, replacement=True,
-                                       num_samples=2)
-    test_loader = AudioDataLoader(dataset=test_dataset, num_workers=config["num_data_workers"], sampler=sampler)
+    # the evaluator draws the bootstraps with its own random sampler, keep the workers alive between them
+    test_loader = AudioDataLoader(dataset=test_dataset, **data_loader_worker_kwargs(config["num_data_workers"]))
 
     device = torch.device("cuda" if CUDA_ENABLED else "cpu")
 
@@ -6,7 +6,7 @@ import torch
 
 from sonosco.models.seq2seq_las import Seq2Seq
 from sonosco.common.constants import SONOSCO
-from sonosco.common.utils import setup_logging
+from sonosco.common.utils import setup_logging, labels_to_dict
 from sonosco.common.path_utils import parse_yaml
 from sonosco.training import Experiment, ModelTrainer
 from sonosco.datasets import create_data_loaders
@@ -14,7 +14,9 @@ from sonosco.decoders import GreedyDecoder
 from sonosco.training.metrics import word_error_rate, character_error_rate
 from sonosco.training.losses import cross_entropy_loss
 from sonosco.common.global_settings import CUDA_ENABLED
+from sonosco.common.torch_utils import enable_tf32_matmul
 from sonosco.training.tb_callbacks.las_text_comparison_callback import LasTextComparisonCallback
+from sonosco.training.callbacks import ProfilerCallback
 from sonosco.serialization import Deserializer
 
 LOGGER = logging.getLogger(SONOSCO)
@@ -24,10 +26,29 @@ SOS = '#'
 PADDING_VALUE = '%'
 
 
+def start_with_nvtx(experiment: Experiment) -> None:
+    """
+    Run the experiment with an NVTX range around every autograd op. The ranges are only
+    collected when the script runs under an external profiler such as Nsight Systems.
+    """
+    LOGGER.info("Emitting NVTX ranges, run the script under "
+                "'nsys profile -w true -c cudaProfilerApi python train_las.py --profiler nvtx' to collect them.")
+    with torch.autograd.profiler.emit_nvtx():
+        torch.cuda.profiler.start()
+        try:
+            experiment.start()
+        finally:
+            torch.cuda.profiler.stop()
+
+
 @click.command()
 @click.option("-c", "--config_path", default="../sonosco/models/config/train_seq2seq_las.yaml",
               type=click.STRING, help="Path to train configurations.")
-def main(config_path):
+@click.option("--profiler", default="none", type=click.Choice(["none", "nvtx", "kineto"]),
+              help="Profile training, 'nvtx' emits NVTX ranges for Nsight Systems / nvprof, 'kineto' profiles "
+                   "a few training steps with torch.profiler and writes tensorboard traces. "
+                   "Training runs without any profiler by default.")
+def main(config_path, profiler):
     config = parse_yaml(config_path)["train"]
     experiment = Experiment.create(config, LOGGER)
 
@@ -43,12 +64,16 @@ def main(config_path):
         })
     else:
         device = torch.device("cuda" if CUDA_ENABLED else "cpu")
+        if config.get("allow_tf32") or config.get("autocast_dtype"):
+            # let fp32 matmuls that are not autocast run on tensor cores
+            enable_tf32_matmul()
 
         char_list = config["labels"] + EOS + SOS
+        label_to_id = labels_to_dict(char_list)
 
         config["decoder"]["vocab_size"] = len(char_list)
-        config["decoder"]["sos_id"] = char_list.index(SOS)
-        config["decoder"]["eos_id"] = char_list.index(EOS)
+        config["decoder"]["sos_id"] = label_to_id[SOS]
+        config["decoder"]["eos_id"] = label_to_id[EOS]
         model = Seq2Seq(config["encoder"], config["decoder"])
         model.to(device)
 
@@ -60,18 +85,26 @@ def main(config_path):
                                lr=config["learning_rate"], weight_decay=config['weight_decay'],
                                metrics=[word_error_rate, character_error_rate],
                                decoder=GreedyDecoder(config['labels']),
-                               device=device, test_step=config["test_step"], custom_model_eval=True)
+                               device=device, test_step=config["test_step"], custom_model_eval=True,
+                               autocast_dtype=config.get("autocast_dtype"))
 
         trainer.add_callback(LasTextComparisonCallback(labels=char_list,
                                                        log_dir=experiment.plots_path,
                                                        args=config['recognizer']))
         # trainer.add_callback(TbTeacherForcingTextComparisonCallback(log_dir=experiment.plots_path))
 
+    if profiler == 'kineto':
+        experiment.add_directory('profile')
+        trainer.add_callback(ProfilerCallback(log_dir=experiment.profile))
+
     # Setup experiment with a model trainer
 
     experiment.setup_model_trainer(trainer, checkpoints=True, tensorboard=True)
     try:
-        experiment.start()
+        if profiler == 'nvtx':
+            start_with_nvtx(experiment)
+        else:
+            experiment.start()
     except KeyboardInterrupt:
         experiment.stop()
 
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 
+from typing import Optional, Tuple
 from sonosco.common.global_settings import CUDA_ENABLED
 
 SOFT_WINDOW_SIGMA = 4.0
@@ -70,11 +71,25 @@ class DotProductAttention(nn.Module):
         # TODO: move this out of this class?
         # self.linear_out = nn.Linear(dim*2, dim)
 
-    def forward(self, queries: torch.Tensor, values: torch.Tensor) -> (torch.Tensor, torch.Tensor):
+    @staticmethod
+    def precompute_keys(values: torch.Tensor) -> torch.Tensor:
+        """
+        Prepares the keys for attending over the same values many times, e.g. at every
+        step of a beam search.
+        Args:
+            values: N x Ti x H
+        Returns:
+            keys: N x H x Ti
+        """
+        return values.transpose(1, 2).contiguous()
+
+    def forward(self, queries: torch.Tensor, values: torch.Tensor,
+                keys: Optional[torch.Tensor] = None) -> Tuple[torch.Tensor, torch.Tensor]:
         """
         Args:
             queries: N x To x H
             values : N x Ti x H
+            keys: N x H x Ti, optional keys created by precompute_keys(values)
         Returns:
             output: N x To x H
             attention_distribution: N x To x Ti
@@ -82,8 +97,10 @@ class DotProductAttention(nn.Module):
         batch_size = queries.size(0)
         hidden_size = queries.size(2)
         input_lengths = values.size(1)
+        if keys is None:
+            keys = values.transpose(1, 2)
         # (N, To, H) * (N, H, Ti) -> (N, To, Ti)
-        attention_scores = torch.bmm(queries, values.transpose(1, 2))
+        attention_scores = torch.bmm(queries, keys)
         attention_distribution = F.softmax(
             attention_scores.view(-1, input_lengths), dim=1).view(batch_size, -1, input_lengths)
         # (N, To, Ti) * (N, Ti, H) -> (N, To, H)
@@ -7,5 +7,5 @@ CLASS_NAME_FIELD: str = "__class_name"
 SERIALIZED_FIELD: str = "__serialized"
 SONOSCO_CONFIG_SERIALIZE_NAME = '__sonosco_config__'
 
-PRIMITIVES: set = {int, float, str, bool}
-COLLECTIONS: set = {list, set, tuple, dict}
+PRIMITIVES: frozenset = frozenset({int, float, str, bool})
+COLLECTIONS: frozenset = frozenset({list, set, tuple, dict})
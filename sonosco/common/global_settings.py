@@ -1,5 +1,8 @@
+import re
 import torch
 
 USE_CUDA = True
 CUDA_ENABLED = USE_CUDA and torch.cuda.is_available()
 DEVICE = torch.device("cuda" if CUDA_ENABLED else "cpu")
+# (major, minor) of the installed torch, e.g. (1, 2) for 1.2.0 or (2, 1) for 2.1.0+cu118
+TORCH_VERSION = tuple(int(v) for v in re.findall(r'\d+', torch.__version__)[:2])
@@ -0,0 +1,80 @@
+import logging
+import contextlib
+import torch
+
+from typing import Optional, Callable, Any
+
+LOGGER = logging.getLogger(__name__)
+
+AUTOCAST_DTYPES = (None, 'bfloat16', 'float16')
+
+
+def resolve_autocast_dtype(autocast_dtype: Optional[str], device: Optional[torch.device]) -> Optional[torch.dtype]:
+    """
+    Resolves a mixed precision setting for a device. Autocast is only used on gpus that support the dtype
+    with torch versions that provide torch.autocast (>= 1.10), otherwise the model runs in float32.
+    Args:
+        autocast_dtype: 'bfloat16', 'float16' or None
+        device: device the model runs on
+
+    Returns: dtype to autocast to, None if the model runs in float32
+
+    """
+    if autocast_dtype not in AUTOCAST_DTYPES:
+        raise ValueError(f"Unsupported autocast dtype: {autocast_dtype}")
+    if autocast_dtype is None:
+        return None
+    if device is None or device.type != 'cuda':
+        LOGGER.warning(f"Mixed precision is only used on gpus, running in float32 on {device}")
+        return None
+    if not hasattr(torch, 'autocast'):
+        LOGGER.warning(f"torch.autocast is not available in torch {torch.__version__}, running in float32")
+        return None
+    if autocast_dtype == 'bfloat16' and not torch.cuda.is_bf16_supported():
+        LOGGER.warning(f"bfloat16 is not supported by {torch.cuda.get_device_name(device)}, running in float32")
+        return None
+    return getattr(torch, autocast_dtype)
+
+
+def autocast(device: Optional[torch.device], dtype: Optional[torch.dtype]):
+    """
+    Context in which a model is evaluated in mixed precision.
+    Args:
+        device: device the model runs on
+        dtype: dtype returned by resolve_autocast_dtype
+
+    Returns: torch.autocast context, a no-op context if dtype is None
+
+    """
+    if dtype is None:
+        return contextlib.suppress()  # no-op context
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def enable_tf32_matmul() -> None:
+    """
+    Lets float32 matmuls that are not autocast run on tensor cores in TF32 (torch >= 1.7, ampere gpus).
+    This changes numerical results, so it is only enabled when a configuration asks for it.
+    """
+    if not hasattr(torch.backends.cuda, 'matmul'):
+        LOGGER.warning(f"TF32 matmuls are not available in torch {torch.__version__}, running in float32")
+        return
+    torch.backends.cuda.matmul.allow_tf32 = True
+
+
+def compile_if_available(fn: Callable, description: str, **kwargs: Any) -> Callable:
+    """
+    Compiles a function or module with torch.compile (torch >= 2.0).
+    Args:
+        fn: function or module to compile
+        description: what is compiled, used in the warning if torch.compile is not available
+        **kwargs: arguments of torch.compile
+
+    Returns: compiled fn, fn itself if torch.compile is not available
+
+    """
+    if not hasattr(torch, 'compile'):
+        LOGGER.warning(f"torch.compile is not available in torch {torch.__version__}, "
+                       f"{description} will not be compiled")
+        return fn
+    return torch.compile(fn, **kwargs)
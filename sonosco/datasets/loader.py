@@ -1,4 +1,5 @@
 import logging
+import inspect
 import torch
 import torch.nn
 
@@ -7,6 +8,8 @@ from .dataset import AudioDataProcessor, AudioDataset
 from .samplers import BucketingSampler
 
 LOGGER = logging.getLogger(__name__)
+# persistent_workers and prefetch_factor were added to the DataLoader in torch 1.7
+PERSISTENT_WORKERS_SUPPORTED = 'persistent_workers' in inspect.signature(DataLoader.__init__).parameters
 
 
 class AudioDataLoader(DataLoader):
@@ -55,6 +58,23 @@ class AudioDataLoader(DataLoader):
         return inputs, targets, input_lengths, target_lengths
 
 
+def data_loader_worker_kwargs(num_workers: int) -> dict:
+    """
+    DataLoader arguments for the worker processes, workers are only kept alive if the torch version supports it.
+    Args:
+        num_workers: number of worker processes
+
+    Returns: keyword arguments for the DataLoader
+
+    """
+    worker_kwargs = dict(num_workers=num_workers, pin_memory=True)
+    if num_workers > 0 and PERSISTENT_WORKERS_SUPPORTED:
+        # keep the workers alive between epochs instead of forking them again at every epoch,
+        # a larger prefetch_factor rarely helps and only costs memory
+        worker_kwargs.update(persistent_workers=True, prefetch_factor=2)
+    return worker_kwargs
+
+
 def create_data_loaders(**kwargs: any) -> (DataLoader, DataLoader, DataLoader):
     """
     Creates DataLoaders for training, validation and test data sets
@@ -65,29 +85,27 @@ def create_data_loaders(**kwargs: any) -> (DataLoader, DataLoader, DataLoader):
 
     """
     processor = AudioDataProcessor(**kwargs)
+    worker_kwargs = data_loader_worker_kwargs(kwargs.get("num_data_workers", 4))
 
     # create train loader
     train_dataset = AudioDataset(processor, manifest_filepath=kwargs["train_manifest"])
     LOGGER.info(f"Training dataset containing {len(train_dataset)} samples is created")
     sampler = BucketingSampler(train_dataset, batch_size=kwargs["batch_size"])
-    train_loader = AudioDataLoader(dataset=train_dataset, num_workers=kwargs["num_data_workers"], batch_sampler=sampler,
-                                   pin_memory=True)
+    train_loader = AudioDataLoader(dataset=train_dataset, batch_sampler=sampler, **worker_kwargs)
     LOGGER.info("Training data loader created.")
 
     # create validation loader
     val_dataset = AudioDataset(processor, manifest_filepath=kwargs["val_manifest"])
     LOGGER.info(f"Validation dataset containing {len(val_dataset)} samples is created")
     sampler = BucketingSampler(val_dataset, batch_size=kwargs["batch_size"])
-    val_loader = AudioDataLoader(dataset=val_dataset, num_workers=kwargs["num_data_workers"], batch_sampler=sampler,
-                                 pin_memory=True)
+    val_loader = AudioDataLoader(dataset=val_dataset, batch_sampler=sampler, **worker_kwargs)
     LOGGER.info("Validation data loader created.")
 
     # create validation loader
     test_dataset = AudioDataset(processor, manifest_filepath=kwargs["test_manifest"])
     LOGGER.info(f"Test dataset containing {len(test_dataset)} samples is created")
     sampler = BucketingSampler(test_dataset, batch_size=kwargs["batch_size"])
-    test_loader = AudioDataLoader(dataset=test_dataset, num_workers=kwargs["num_data_workers"], batch_sampler=sampler,
-                                  pin_memory=True)
+    test_loader = AudioDataLoader(dataset=test_dataset, batch_sampler=sampler, **worker_kwargs)
     LOGGER.info("Test data loader created.")
 
     return train_loader, val_loader, test_loader
@@ -1,25 +1,26 @@
+import math
+import logging
+import functools
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from typing import Dict
+from typing import Dict, Tuple
 from dataclasses import field
-from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence, pad_sequence
+from torch.utils.checkpoint import checkpoint
 from sonosco.serialization import serializable
 from sonosco.blocks.attention import DotProductAttention
 from sonosco.blocks.modules import supported_rnns
+from sonosco.common.global_settings import TORCH_VERSION
+from sonosco.common.torch_utils import compile_if_available
 
-IGNORE_ID = -1
-
+LOGGER = logging.getLogger(__name__)
 
-def pad_list(xs, pad_value):
-    # From: espnet/src/nets/e2e_asr_th.py: pad_list()
-    n_batch = len(xs)
-    max_len = max(x.size(0) for x in xs)
-    pad = xs[0].new(n_batch, max_len, *xs[0].size()[1:]).fill_(pad_value)
-    for i in range(n_batch):
-        pad[i, :xs[i].size(0)] = xs[i]
-    return pad
+IGNORE_ID = -1
+# the non-reentrant checkpoint (torch >= 1.11) supports keyword arguments and inputs without
+# requires_grad, newer versions warn if use_reentrant is not passed explicitly
+CHECKPOINT_KWARGS = dict(use_reentrant=False) if TORCH_VERSION >= (1, 11) else {}
 
 
 @serializable(model=True)
@@ -61,6 +62,16 @@ class Seq2Seq(nn.Module):
                                                  args)
         return nbest_hyps
 
+    def quantize_for_inference(self) -> nn.Module:
+        """Creates a copy of the model with the weights of the LSTMs and linear layers dynamically
+        quantized to int8, meant for inference (e.g. recognize) on cpu.
+
+        Returns:
+            quantized copy of the model, the model itself is left unchanged
+        """
+        return torch.quantization.quantize_dynamic(self, {nn.LSTM, nn.Linear},
+                                                   dtype=torch.qint8, inplace=False)
+
 
 @serializable
 class Encoder(nn.Module):
@@ -90,6 +101,10 @@ class Encoder(nn.Module):
             - **output**: N x T x H
             - **hidden**: (num_layers * num_directions) x N x H
         """
+        # replicas created by nn.DataParallel hold non-contiguous weights, cuDNN would fall
+        # back to a slow path without flattening them (dynamically quantized rnns have no such weights)
+        if isinstance(self.rnn, nn.RNNBase):
+            self.flatten_parameters()
         # Add total_length for supportting nn.DataParallel() later
         # see https://pytorch.org/docs/stable/notes/faq.html#pack-rnn-unpack-with-data-parallelism
         total_length = padded_input.size(1)  # get the max sequence length
@@ -119,19 +134,20 @@ class Decoder(nn.Module):
     hidden_size: int
     num_layers: int
     bidirectional_encoder: bool = True  # useless now
+    # trade compute for memory: recompute the decoder steps during backward, see forward
+    gradient_checkpointing: bool = False
+    # compile the decoder step with torch.compile (requires torch >= 2.0)
+    compile_step: bool = False
 
     # Components
     def __post_init__(self):
         super(Decoder, self).__init__()
         self.encoder_hidden_size = self.hidden_size
         self.embedding = nn.Embedding(self.vocab_size, self.embedding_dim)
-        self.rnn = nn.ModuleList()
-
-        self.rnn += [nn.LSTMCell(self.embedding_dim +
-                                 self.encoder_hidden_size, self.hidden_size)]
-
-        for l in range(1, self.num_layers):
-            self.rnn += [nn.LSTMCell(self.hidden_size, self.hidden_size)]
+        # single multi-layer LSTM stepped one timestep at a time, so that every step
+        # runs as one fused cuDNN call instead of one LSTMCell call per layer
+        self.rnn = nn.LSTM(self.embedding_dim + self.encoder_hidden_size, self.hidden_size,
+                           self.num_layers, batch_first=True)
 
         self.attention = DotProductAttention()
 
@@ -146,72 +162,152 @@ class Decoder(nn.Module):
         H = self.hidden_size if H == None else H
         return encoder_padded_outputs.new_zeros(N, H)
 
-    def forward(self, padded_input, encoder_padded_outputs):
+    def zero_rnn_state(self, encoder_padded_outputs):
+        """
+        Args:
+            encoder_padded_outputs: N x Ti x H
+        Returns: h, c
+            - **h**: num_layers x N x H
+            - **c**: num_layers x N x H
+        """
+        N = encoder_padded_outputs.size(0)
+        h = encoder_padded_outputs.new_zeros(self.num_layers, N, self.hidden_size)
+        c = encoder_padded_outputs.new_zeros(self.num_layers, N, self.hidden_size)
+        return h, c
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # checkpoints created with the former stack of LSTMCells store the weights of
+        # layer l under rnn.<l>.<name>, nn.LSTM expects them under rnn.<name>_l<l>
+        for l in range(self.num_layers):
+            for name in ('weight_ih', 'weight_hh', 'bias_ih', 'bias_hh'):
+                cell_key = f'{prefix}rnn.{l}.{name}'
+                if cell_key in state_dict:
+                    state_dict[f'{prefix}rnn.{name}_l{l}'] = state_dict.pop(cell_key)
+        super(Decoder, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                   missing_keys, unexpected_keys, error_msgs)
+
+    def _run_step(self, *args: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Runs _step, compiled if compile_step is set. The compiled function is not stored on the module,
+        so that replicas (nn.DataParallel), copies and pickled models keep working.
+        """
+        if self.compile_step:
+            return _compiled_decoder_step()(self, *args)
+        return self._step(*args)
+
+    def _step(self, embedded: torch.Tensor, att_c: torch.Tensor, h: torch.Tensor, c: torch.Tensor,
+              encoder_padded_outputs: torch.Tensor, encoder_keys: torch.Tensor) \
+            -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
         """
+        Runs one decoder step for a batch of sequences.
         Args:
-            padded_input: N x To
+            embedded: N x D, embedding of the previous output
+            att_c: N x H, previous attention context
+            h: num_layers x N x H
+            c: num_layers x N x H
+            encoder_padded_outputs: N x Ti x H
+            encoder_keys: N x H x Ti
+        Returns: mlp_input, att_c, h, c
+            - **mlp_input**: N x 2H, concatenation of s_i and c_i, self.mlp maps it to the N x C output
+            - **att_c**: N x H
+            - **h**: num_layers x N x H
+            - **c**: num_layers x N x H
+        """
+        # step 1. decoder RNN: s_i = RNN(s_i−1,y_i−1,c_i−1)
+        rnn_input = torch.cat((embedded, att_c), dim=1)
+        # (N x D) -> (N x 1 x D) -> (N x 1 x H) -> (N x H)
+        rnn_output, (h, c) = self.rnn(rnn_input.unsqueeze(dim=1), (h, c))
+        rnn_output = rnn_output.squeeze(dim=1)
+        # step 2. attention: c_i = AttentionContext(s_i,h)
+        # below unsqueeze: (N x H) -> (N x 1 x H)
+        att_c, att_w = self.attention(rnn_output.unsqueeze(dim=1),
+                                      encoder_padded_outputs, encoder_keys)
+        att_c = att_c.squeeze(dim=1)
+        # step 3. concate s_i and c_i, the MLP is applied by the caller
+        mlp_input = torch.cat((rnn_output, att_c), dim=1)
+        return mlp_input, att_c, h, c
+
+    def _decode_steps(self, embedded: torch.Tensor, att_c: torch.Tensor, h: torch.Tensor, c: torch.Tensor,
+                      encoder_padded_outputs: torch.Tensor, encoder_keys: torch.Tensor) \
+            -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Runs the decoder over a sequence of teacher forced inputs.
+        Args:
+            embedded: N x T x D
+            att_c: N x H
+            h: num_layers x N x H
+            c: num_layers x N x H
+            encoder_padded_outputs: N x Ti x H
+            encoder_keys: N x H x Ti
+        Returns: y_all, att_c, h, c
+            - **y_all**: N x T x C
+            - **att_c**, **h**, **c**: decoder state after the last step
+        """
+        # the output MLP does not feed back into the recurrence, collect its inputs and
+        # run it once over all T steps as a few large matmuls instead of T small ones
+        mlp_inputs = embedded.new_empty(embedded.size(0), embedded.size(1),
+                                        self.hidden_size + encoder_padded_outputs.size(2))
+        for t in range(embedded.size(1)):
+            mlp_inputs[:, t], att_c, h, c = self._run_step(embedded[:, t, :], att_c, h, c,
+                                                           encoder_padded_outputs, encoder_keys)
+        y_all = self.mlp(mlp_inputs)
+        return y_all, att_c, h, c
+
+    def forward(self, padded_input: torch.Tensor, encoder_padded_outputs: torch.Tensor):
+        """
+        Args:
+            padded_input: N x To, padded with IGNORE_ID (or a sequence of N unpadded targets)
             # encoder_hidden: (num_layers * num_directions) x N x H
             encoder_padded_outputs: N x Ti x H
         Returns:
         """
         # *********Get Input and Output
-        # from espnet/Decoder.forward()
-        # TODO: need to make more smart way
-        ys = [y[y != IGNORE_ID] for y in padded_input]  # parse padded ys
-        # prepare input and output word sequences with sos/eos IDs
-        eos = ys[0].new([self.eos_id])
-        sos = ys[0].new([self.sos_id])
-        ys_in = [torch.cat([sos, y], dim=0) for y in ys]
-        ys_out = [torch.cat([y, eos], dim=0) for y in ys]
-        y_lens = [y.size(0) for y in ys_in]
-        # padding for ys with -1
-        # pys: utt x olen
-        ys_in_pad = pad_list(ys_in, self.eos_id).type(torch.long)
-        ys_out_pad = pad_list(ys_out, IGNORE_ID).type(torch.long)
-        # print("ys_in_pad", ys_in_pad.size())
-        assert ys_in_pad.size() == ys_out_pad.size()
+        if not torch.is_tensor(padded_input):
+            # targets given as a sequence of unpadded 1-D tensors
+            padded_input = pad_sequence(padded_input, batch_first=True, padding_value=IGNORE_ID)
+        padded_input = padded_input.long()
+        # prepare input and output word sequences with sos/eos IDs, built on device without
+        # per utterance work: ys_in = <sos> y <eos> ..., ys_out = y <eos> <ignore> ...
+        pad_mask = padded_input == IGNORE_ID
+        lengths = (~pad_mask).sum(dim=1)
+        ys_in_pad = padded_input.new_full((padded_input.size(0), padded_input.size(1) + 1), self.eos_id)
+        ys_in_pad[:, 0] = self.sos_id
+        ys_in_pad[:, 1:] = padded_input.masked_fill(pad_mask, self.eos_id)
+        ys_out_pad = padded_input.new_full((padded_input.size(0), padded_input.size(1) + 1), IGNORE_ID)
+        ys_out_pad[:, :-1] = padded_input
+        ys_out_pad.scatter_(1, lengths.unsqueeze(1), self.eos_id)
+        y_lens = lengths + 1
         batch_size = ys_in_pad.size(0)
         output_length = ys_in_pad.size(1)
         # max_length = ys_in_pad.size(1) - 1  # TODO: should minus 1(sos)?
 
         # *********Init decoder rnn
-        h_list = [self.zero_state(encoder_padded_outputs)]
-        c_list = [self.zero_state(encoder_padded_outputs)]
-        for l in range(1, self.num_layers):
-            h_list.append(self.zero_state(encoder_padded_outputs))
-            c_list.append(self.zero_state(encoder_padded_outputs))
+        h, c = self.zero_rnn_state(encoder_padded_outputs)
         att_c = self.zero_state(encoder_padded_outputs,
                                 H=encoder_padded_outputs.size(2))
-        y_all = []
+        encoder_keys = DotProductAttention.precompute_keys(encoder_padded_outputs)
 
         # **********LAS: 1. decoder rnn 2. attention 3. concate and MLP
         embedded = self.embedding(ys_in_pad)
-        for t in range(output_length):
-            # step 1. decoder RNN: s_i = RNN(s_i−1,y_i−1,c_i−1)
-            rnn_input = torch.cat((embedded[:, t, :], att_c), dim=1)
-            h_list[0], c_list[0] = self.rnn[0](
-                rnn_input, (h_list[0], c_list[0]))
-            for l in range(1, self.num_layers):
-                h_list[l], c_list[l] = self.rnn[l](
-                    h_list[l - 1], (h_list[l], c_list[l]))
-            rnn_output = h_list[-1]  # below unsqueeze: (N x H) -> (N x 1 x H)
-            # step 2. attention: c_i = AttentionContext(s_i,h)
-            att_c, att_w = self.attention(rnn_output.unsqueeze(dim=1),
-                                          encoder_padded_outputs)
-            att_c = att_c.squeeze(dim=1)
-            # step 3. concate s_i and c_i, and input to MLP
-            mlp_input = torch.cat((rnn_output, att_c), dim=1)
-            predicted_y_t = self.mlp(mlp_input)
-            y_all.append(predicted_y_t)
-
-        y_all = torch.stack(y_all, dim=1)  # N x To x C
+        if self.gradient_checkpointing and self.training:
+            # split the To steps into chunks of ~sqrt(To) steps, only the decoder state between
+            # chunks is kept for backward and the steps of a chunk are recomputed
+            chunk_size = max(1, int(math.sqrt(output_length)))
+            y_all = embedded.new_empty(batch_size, output_length, self.vocab_size)  # N x To x C
+            for start in range(0, output_length, chunk_size):
+                y_all[:, start:start + chunk_size], att_c, h, c = checkpoint(
+                    self._decode_steps, embedded[:, start:start + chunk_size],
+                    att_c, h, c, encoder_padded_outputs, encoder_keys, **CHECKPOINT_KWARGS)
+        else:
+            y_all, _, _, _ = self._decode_steps(embedded, att_c, h, c,
+                                                encoder_padded_outputs, encoder_keys)  # N x To x C
         model_out = y_all
         # **********Cross Entropy Loss
         # F.cross_entropy = NLL(log_softmax(input), target))
-        y_all = y_all.view(batch_size * output_length, self.vocab_size)
-        ce_loss = F.cross_entropy(y_all, ys_out_pad.view(-1),
+        ce_loss = F.cross_entropy(y_all.reshape(-1, self.vocab_size), ys_out_pad.reshape(-1),
                                   ignore_index=IGNORE_ID,
-                                  reduction='elementwise_mean')
+                                  reduction='mean')
         # TODO: should minus 1 here ?
         # ce_loss *= (np.mean([len(y) for y in ys_in]) - 1)
         # print("ys_in\n", ys_in)
@@ -268,96 +364,69 @@ class Decoder(nn.Module):
         else:
             maxlen = args['decode_max_len']
 
+        # the encoder memory is the same for every step and hypothesis, prepare it only once
+        encoder_outputs = encoder_outputs.unsqueeze(0)
+        encoder_keys = DotProductAttention.precompute_keys(encoder_outputs)
+
         # *********Init decoder rnn
-        h_list = [self.zero_state(encoder_outputs.unsqueeze(0))]
-        c_list = [self.zero_state(encoder_outputs.unsqueeze(0))]
-        for l in range(1, self.num_layers):
-            h_list.append(self.zero_state(encoder_outputs.unsqueeze(0)))
-            c_list.append(self.zero_state(encoder_outputs.unsqueeze(0)))
-        att_c = self.zero_state(encoder_outputs.unsqueeze(0),
-                                H=encoder_outputs.unsqueeze(0).size(2))
-        # prepare sos
-        y = self.sos_id
-        vy = encoder_outputs.new_zeros(1).long()
-
-        hyp = {'score': 0.0, 'yseq': [y], 'c_prev': c_list, 'h_prev': h_list,
-               'a_prev': att_c}
-        hyps = [hyp]
-        ended_hyps = []
+        # the live hypotheses are the rows of dense tensors:
+        # yseq: num_hyps x (maxlen + 2), scores: num_hyps, att_c: num_hyps x H, h/c: num_layers x num_hyps x H
+        h, c = self.zero_rnn_state(encoder_outputs)
+        att_c = self.zero_state(encoder_outputs,
+                                H=encoder_outputs.size(2))
+        scores = encoder_outputs.new_zeros(1)
+        # prepare sos, the remaining positions are prefilled with eos
+        yseq = encoder_outputs.new_full((1, maxlen + 2), self.eos_id, dtype=torch.long)
+        yseq[:, 0] = self.sos_id
+        ended_scores, ended_yseqs = [], []
 
         for i in range(maxlen):
-            hyps_best_kept = []
-            for hyp in hyps:
-                # vy.unsqueeze(1)
-                vy[0] = hyp['yseq'][i]
-                embedded = self.embedding(vy)
-                # embedded.unsqueeze(0)
-                # step 1. decoder RNN: s_i = RNN(s_i−1,y_i−1,c_i−1)
-                rnn_input = torch.cat((embedded, hyp['a_prev']), dim=1)
-                h_list[0], c_list[0] = self.rnn[0](
-                    rnn_input, (hyp['h_prev'][0], hyp['c_prev'][0]))
-                for l in range(1, self.num_layers):
-                    h_list[l], c_list[l] = self.rnn[l](
-                        h_list[l - 1], (hyp['h_prev'][l], hyp['c_prev'][l]))
-                rnn_output = h_list[-1]
-                # step 2. attention: c_i = AttentionContext(s_i,h)
-                # below unsqueeze: (N x H) -> (N x 1 x H)
-                att_c, att_w = self.attention(rnn_output.unsqueeze(dim=1),
-                                              encoder_outputs.unsqueeze(0))
-                att_c = att_c.squeeze(dim=1)
-                # step 3. concate s_i and c_i, and input to MLP
-                mlp_input = torch.cat((rnn_output, att_c), dim=1)
-                predicted_y_t = self.mlp(mlp_input)
-                local_scores = F.log_softmax(predicted_y_t, dim=1)
-                # topk scores
-                local_best_scores, local_best_ids = torch.topk(
-                    local_scores, beam, dim=1)
-
-                for j in range(beam):
-                    new_hyp = {}
-                    new_hyp['h_prev'] = h_list[:]
-                    new_hyp['c_prev'] = c_list[:]
-                    new_hyp['a_prev'] = att_c[:]
-                    new_hyp['score'] = hyp['score'] + local_best_scores[0, j]
-                    new_hyp['yseq'] = [0] * (1 + len(hyp['yseq']))
-                    new_hyp['yseq'][:len(hyp['yseq'])] = hyp['yseq']
-                    new_hyp['yseq'][len(hyp['yseq'])] = int(
-                        local_best_ids[0, j])
-                    # will be (2 x beam) hyps at most
-                    hyps_best_kept.append(new_hyp)
-
-                hyps_best_kept = sorted(hyps_best_kept,
-                                        key=lambda x: x['score'],
-                                        reverse=True)[:beam]
-            # end for hyp in hyps
-            hyps = hyps_best_kept
-
-            # add eos in the final loop to avoid that there are no ended hyps
+            # all hypotheses are decoded together as one batch of size num_hyps
+            num_hyps = yseq.size(0)
+            embedded = self.embedding(yseq[:, i])
+            mlp_input, att_c, h, c = self._run_step(embedded, att_c, h, c,
+                                                    encoder_outputs.expand(num_hyps, -1, -1),
+                                                    encoder_keys.expand(num_hyps, -1, -1))
+            predicted_y_t = self.mlp(mlp_input)
+            local_scores = F.log_softmax(predicted_y_t, dim=1)
+            # scores of all (num_hyps x C) expansions, keep the global topk
+            scores, best_ids = torch.topk((scores.unsqueeze(1) + local_scores).view(-1), beam)
+            best_hyp_ids = best_ids // self.vocab_size
+            yseq = yseq[best_hyp_ids]
+            yseq[:, i + 1] = best_ids % self.vocab_size
+            att_c = att_c[best_hyp_ids]
+            h = h[:, best_hyp_ids]
+            c = c[:, best_hyp_ids]
+
+            # add ended hypotheses to a final list, and remove them from the current hypotheses
+            # (this will be a problem, number of hyps < beam)
             if i == maxlen - 1:
-                for hyp in hyps:
-                    hyp['yseq'].append(self.eos_id)
-
-            # add ended hypothes to a final list, and removed them from current hypothes
-            # (this will be a probmlem, number of hyps < beam)
-            remained_hyps = []
-            for hyp in hyps:
-                if hyp['yseq'][-1] == self.eos_id:
-                    # hyp['score'] += (i + 1) * penalty
-                    ended_hyps.append(hyp)
-                else:
-                    remained_hyps.append(hyp)
-
-            hyps = remained_hyps
-            # if len(hyps) > 0:
-            #     print('remeined hypothes: ' + str(len(hyps)))
-            # else:
-            #     print('no hypothesis. Finish decoding.')
-            #     break
-            #
-            # for hyp in hyps:
-            #     print('hypo: ' + ''.join([char_list[int(x)]
-            #                               for x in hyp['yseq'][1:]]))
+                # end all hypotheses in the final loop, the eos at i + 2 avoids that there are no ended hyps
+                ended_scores.append(scores)
+                ended_yseqs.append(yseq[:, :i + 3])
+                break
+            ended = yseq[:, i + 1] == self.eos_id
+            ended_scores.append(scores[ended])
+            ended_yseqs.append(yseq[ended, :i + 2])
+            remained = ~ended
+            scores, yseq, att_c = scores[remained], yseq[remained], att_c[remained]
+            h, c = h[:, remained], c[:, remained]
+            if yseq.size(0) == 0:
+                break
         # end for i in range(maxlen)
-        nbest_hyps = sorted(ended_hyps, key=lambda x: x['score'], reverse=True)[
-                     :min(len(ended_hyps), nbest)]
+        ended_hyps = [{'score': score, 'yseq': seq}
+                      for step_scores, step_yseqs in zip(ended_scores, ended_yseqs)
+                      for score, seq in zip(step_scores.tolist(), step_yseqs.tolist())]
+        nbest_hyps = sorted(ended_hyps, key=lambda x: x['score'], reverse=True)[:nbest]
         return nbest_hyps
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_decoder_step():
+    """
+    Decoder._step compiled once for all decoders, it is called with the decoder as first argument.
+    A step is a handful of tiny kernels, inductor fuses them and replays the step as a CUDA graph instead of
+    launching every kernel separately. The batch size and Ti vary, with the default dynamic=None the step is
+    recompiled with dynamic shapes after the first shape change instead of once per shape.
+    """
+    return compile_if_available(Decoder._step, 'the decoder step', mode='reduce-overhead')
@@ -1,10 +1,13 @@
 import inspect
+import importlib
+import functools
 
-from typing import Set
+from typing import FrozenSet
 from sonosco.common.constants import COLLECTIONS, PRIMITIVES, CLASS_MODULE_FIELD, CLASS_NAME_FIELD, SERIALIZED_FIELD
 
 
-def get_constructor_args(cls) -> Set[str]:
+@functools.lru_cache(maxsize=None)
+def get_constructor_args(cls) -> FrozenSet[str]:
     """
     E.g.
 
@@ -16,12 +19,13 @@ def get_constructor_args(cls) -> Set[str]:
     Args:
         cls (object):
 
-    Returns: set containing names of constructor arguments
+    Returns: frozenset containing names of constructor arguments (cached per class)
 
     """
-    return set(inspect.getfullargspec(cls.__init__).args[1:])
+    return frozenset(inspect.getfullargspec(cls.__init__).args[1:])
 
 
+@functools.lru_cache(maxsize=None)
 def get_class_by_name(name: str) -> type:
     """
     Returns type object of class specified by name
@@ -31,11 +35,8 @@ def get_class_by_name(name: str) -> type:
     Returns: class object
 
     """
-    components = name.split('.')
-    mod = __import__(components[0])
-    for comp in components[1:]:
-        mod = getattr(mod, comp)
-    return mod
+    module_name, _, class_name = name.rpartition('.')
+    return getattr(importlib.import_module(module_name), class_name)
 
 
 def is_serialized_collection_of_serializables(obj: any) -> bool:
@@ -28,6 +28,6 @@ class AbstractCallback(ABC):
 
     def close(self) -> None:
         """
-        Handle cleanup work if necessary. Will be called at the end of the last epoch.
+        Handle cleanup work if necessary. Will be called at the end of the last epoch or when training is interrupted.
         """
         pass
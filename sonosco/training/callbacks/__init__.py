@@ -1,4 +1,5 @@
 from .epoch_duration_estimation_callback import EpochEstimationCallback
 from .early_stopping import EarlyStopping
 from .disable_soft_window_attention import DisableSoftWindowAttention
-from .model_checkpoint import ModelCheckpoint
\ No newline at end of file
+from .model_checkpoint import ModelCheckpoint
+from .profiler import ProfilerCallback
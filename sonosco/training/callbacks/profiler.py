@@ -0,0 +1,86 @@
+import logging
+import torch
+
+from typing import Dict
+from sonosco.serialization import serializable
+from ..abstract_callback import AbstractCallback, ModelTrainer
+
+LOGGER = logging.getLogger(__name__)
+
+
+@serializable
+class ProfilerCallback(AbstractCallback):
+    """
+    Profiles training steps with the Kineto based torch.profiler (requires torch >= 1.8.1) and writes
+    the traces for tensorboard to log_dir. The profiler skips `wait` batches, warms up for `warmup`
+    batches and records the following `active` batches, `repeat` times.
+
+    Args:
+        log_dir (str): output directory of the traces
+        wait (int): number of batches to skip before each recording cycle
+        warmup (int): number of batches that are traced but discarded before recording
+        active (int): number of recorded batches per cycle
+        repeat (int): number of recording cycles
+
+    """
+    log_dir: str
+    wait: int = 1
+    warmup: int = 1
+    active: int = 3
+    repeat: int = 1
+
+    def __post_init__(self) -> None:
+        """
+        Post initialization.
+        """
+        self._profiler = None
+
+    def _start_profiler(self, device: torch.device) -> None:
+        """
+        Create and start the profiler.
+
+        Args:
+            device: training device, cuda activity is profiled on gpus
+
+        """
+        # imported here so that the callback module can be loaded with older torch versions
+        from torch.profiler import profile, schedule, tensorboard_trace_handler, ProfilerActivity
+
+        activities = [ProfilerActivity.CPU]
+        if device is not None and device.type == 'cuda':
+            activities.append(ProfilerActivity.CUDA)
+        self._profiler = profile(activities=activities,
+                                 schedule=schedule(wait=self.wait, warmup=self.warmup,
+                                                   active=self.active, repeat=self.repeat),
+                                 on_trace_ready=tensorboard_trace_handler(self.log_dir),
+                                 record_shapes=True,
+                                 with_stack=True)
+        self._profiler.start()
+        LOGGER.info(f"Profiling training steps, traces are written to {self.log_dir}")
+
+    def __call__(self,
+                 epoch: int,
+                 step: int,
+                 performance_measures: Dict,
+                 context: ModelTrainer) -> None:
+        """
+        Mark the end of a training step for the profiler.
+
+        Args:
+            epoch: epoch step
+            step: step inside of the epoch
+            performance_measures: performance measures dictionary
+            context: model trainer
+
+        """
+        if self._profiler is None:
+            self._start_profiler(context.device)
+        self._profiler.step()
+
+    def close(self) -> None:
+        """
+        Stop the profiler, the trace of an interrupted recording cycle is written as well.
+        """
+        if self._profiler is not None:
+            self._profiler.stop()
+            self._profiler = None
@@ -1,20 +1,168 @@
 import logging
 import torch
 import torch.nn
+import torch.nn.functional as F
 import torch.optim.optimizer
 import os
 import json
+import math
 import numpy as np
+import itertools
+import contextlib
 
 from dataclasses import field, dataclass
-from torch.utils.data import RandomSampler
 from collections import defaultdict
-from typing import Callable, Union, Tuple, List, Any, Dict
+from torch.utils.data import Sampler
+from typing import Callable, Union, Tuple, List, Any, Dict, Iterator
 from torch.utils.data import DataLoader
 from torch.utils.tensorboard import SummaryWriter
 from sonosco.decoders.decoder import Decoder
+from sonosco.common.torch_utils import resolve_autocast_dtype, autocast, compile_if_available
 
 LOGGER = logging.getLogger(__name__)
+# maximum number of cuda streams the bootstraps are distributed over
+MAX_BOOTSTRAP_STREAMS = 4
+# metrics that need the decoder to transcribe the model output
+DECODER_METRICS = frozenset({'word_error_rate', 'character_error_rate'})
+
+
+class _CUDAPrefetcher:
+    """
+    Copies the next batch to the gpu on a side stream while the current batch is processed,
+    so that the host to device transfer overlaps with the forward pass.
+
+    Args:
+        batches: iterator over batches on the cpu (should be in pinned memory)
+        to_device: moves a (nested) batch to the gpu
+    """
+
+    def __init__(self, batches: Iterator, to_device: Callable[[Any], Any]):
+        self.batches = batches
+        self.to_device = to_device
+        self.stream = torch.cuda.Stream()
+        self.batch = None
+        self.preload()
+
+    def preload(self) -> None:
+        try:
+            batch = next(self.batches)
+        except StopIteration:
+            self.batch = None
+            return
+        # to_device may reuse the device memory of the batch before last, which is only safe
+        # once the work queued on the current stream so far (that batch's forward pass) is done
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            self.batch = self.to_device(batch)
+
+    def __iter__(self) -> '_CUDAPrefetcher':
+        return self
+
+    def __next__(self) -> Any:
+        if self.batch is None:
+            raise StopIteration
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(self.stream)
+        batch = self.batch
+        # the tensors were allocated on the side stream, tell the allocator that they are used on the current one
+        _record_stream(batch, current_stream)
+        self.preload()
+        return batch
+
+
+def _record_stream(tensors: Any, stream: torch.cuda.Stream) -> None:
+    if isinstance(tensors, (list, tuple)):
+        for tensor in tensors:
+            _record_stream(tensor, stream)
+    elif torch.is_tensor(tensors):
+        tensors.record_stream(stream)
+
+
+class _StagingBuffers:
+    """
+    Reusable pinned host and device buffers that batches are copied through to the gpu, so that the
+    allocator does not have to find new memory for every batch. Batches are padded to varying lengths,
+    therefore there is one flat buffer per slot, tensor position and dtype that grows to the largest tensor
+    seen, the tensors of a batch are copied into views of it. Two slots are alternated, so that the next
+    batch can be copied while the current one is used (see _CUDAPrefetcher).
+
+    Args:
+        device: gpu to copy the batches to
+        num_slots: number of batches that can be alive at the same time
+    """
+
+    def __init__(self, device: torch.device, num_slots: int = 2):
+        self.device = device
+        self.num_slots = num_slots
+        self.slot = 0
+        self.pinned_buffers = {}
+        self.device_buffers = {}
+        self.copy_done = [None] * num_slots
+
+    def to_device(self, tensors: Any) -> Any:
+        """
+        Copies a (nested) batch to the gpu on the current stream.
+
+        Args:
+            tensors: list of tensors or tensor tuples, can be nested
+
+        Returns: the same structure with the tensors in the device buffers of the next slot
+
+        """
+        self.slot = (self.slot + 1) % self.num_slots
+        if self.copy_done[self.slot] is not None:
+            # the pinned buffers of this slot may still be read by the copies of an earlier batch
+            self.copy_done[self.slot].synchronize()
+        batch = self._copy(tensors, itertools.count())
+        self.copy_done[self.slot] = torch.cuda.Event()
+        self.copy_done[self.slot].record()
+        return batch
+
+    def _copy(self, tensors: Any, positions: Iterator[int]) -> Any:
+        if torch.is_tensor(tensors):
+            return self._copy_tensor(tensors, next(positions))
+        if isinstance(tensors, (list, tuple)):
+            return type(tensors)(self._copy(tensor, positions) for tensor in tensors)
+        return tensors
+
+    def _copy_tensor(self, tensor: torch.Tensor, position: int) -> torch.Tensor:
+        key = (self.slot, position, tensor.dtype)
+        numel = tensor.numel()
+        source = tensor.reshape(-1)
+        if not tensor.is_pinned():
+            # only pinned memory can be copied asynchronously
+            pinned = self._buffer(self.pinned_buffers, key, numel, tensor.dtype, pin_memory=True)[:numel]
+            pinned.copy_(source)
+            source = pinned
+        on_device = self._buffer(self.device_buffers, key, numel, tensor.dtype, device=self.device)[:numel]
+        on_device.copy_(source, non_blocking=True)
+        return on_device.view(tensor.shape)
+
+    @staticmethod
+    def _buffer(buffers: dict, key: Tuple, numel: int, dtype: torch.dtype, **kwargs) -> torch.Tensor:
+        buffer = buffers.get(key)
+        if buffer is None or buffer.numel() < numel:
+            buffer = torch.empty(numel, dtype=dtype, **kwargs)
+            buffers[key] = buffer
+        return buffer
+
+
+class _FixedSampler(Sampler):
+    """
+    Yields a fixed list of indices, the list can be replaced between passes over the data loader.
+
+    Args:
+        indices: dataset indices to yield
+    """
+
+    def __init__(self, indices: List[int]):
+        self.indices = indices
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.indices)
+
+    def __len__(self) -> int:
+        return len(self.indices)
 
 
 @dataclass
@@ -26,11 +174,20 @@ class ModelEvaluator:
 
     Args:
         model (nn.Module): model to be evaluated
-        data_loader (utils.data.DataLoader): test data, needs to have a random sampler as batch_sampler or smapler
-        bootstrap_size (int): number of samples that are contained in one bo
+        data_loader (utils.data.DataLoader): test data, its sampler is replaced by one that draws the bootstraps
+        bootstrap_size (int): number of batches (of the batch size of data_loader) that are contained in one bootstrap
         num_bootstraps (int): number of boostraps to compute
         decoder (sonosco.decoders.decoder, optional): decoder to decode model output in order to calculate wer and cer
+        device (torch.device, optional): evaluation device, defaults to the device of the model parameters
         metrics (list of metrics, optional): metrics that are supposed to be evaluated (need to be functions that get model_output, batch (and decoder)
+        decoder_metric_batches (int, optional): number of batches that are decoded together for the decoder based
+            metrics (wer, cer), values > 1 defer their decoding and require model outputs (out, output_sizes) with
+            out of shape batch x seq_length x output_dim
+        compile_model (bool, optional): compile the model forward with torch.compile (requires torch >= 2.0)
+        autocast_dtype (str, optional): 'bfloat16' or 'float16', if set the model forward runs in this precision
+                                        with torch.autocast on gpus that support it
+        eval_batch_size (int, optional): batch size used for evaluation instead of the one of data_loader, evaluation
+                                         needs no memory for gradients and allows larger batches than training
     """
     model: torch.nn.Module
     data_loader: DataLoader
@@ -39,23 +196,71 @@ class ModelEvaluator:
     decoder: Decoder = None
     device: torch.device = None
     metrics: List[Callable[[torch.Tensor, Any], Union[float, torch.Tensor]]] = field(default_factory=list)
+    decoder_metric_batches: int = 1
+    compile_model: bool = False
+    autocast_dtype: str = None
+    eval_batch_size: int = None
     _current_bootstrap_step: int = None
-    _eval_dict: dict = field(default_factory=Dict)
+    _eval_dict: dict = field(default_factory=dict)
 
     def __post_init__(self) -> None:
         """
         Post initialization.
         """
-        self._check_replacement_sampler_in_dataloader()
+        if self.device is None:
+            # evaluate where the model is
+            parameter = next(self.model.parameters(), None)
+            self.device = parameter.device if parameter is not None else torch.device('cpu')
+        self._autocast_dtype = resolve_autocast_dtype(self.autocast_dtype, self.device)
+        self._setup_replacement_sampler_in_dataloader()
+        # one set of staging buffers per cuda stream, see start_evaluation
+        self._staging_buffers = {}
         self._evaluation_done = False
-
-    def _check_replacement_sampler_in_dataloader(self) -> None:
+        self._update_metric_specs()
+        self._deferred_outputs = []
+        self._forward = self.model
+        if self.compile_model:
+            # replays the forward as a CUDA graph instead of launching every kernel separately,
+            # a graph is recorded for every new batch shape
+            self._forward = compile_if_available(self.model, 'the model', mode='reduce-overhead')
+
+    def _setup_replacement_sampler_in_dataloader(self) -> None:
+        """
+        Draws the samples of all bootstraps (with replacement) at once and rebuilds the data loader
+        with a sampler that yields the bootstrap_size batches of the current bootstrap, so that each
+        bootstrap is one pass over the loader. If eval_batch_size is set, the bootstrap keeps its number
+        of samples (rounded up to a multiple of eval_batch_size) but is drawn in larger batches.
         """
-        Check if provided dataloader contains a randomsampler.
+        loader = self.data_loader
+        batch_size = loader.batch_size or 1
+        num_samples = self.bootstrap_size * batch_size
+        if self.eval_batch_size is not None:
+            batch_size = self.eval_batch_size
+            # all batches of a bootstrap have the same size, so that the mean over batches is the mean over samples
+            num_samples = math.ceil(num_samples / batch_size) * batch_size
+        # num_bootstraps x num_samples, drawn with a single call
+        self._bootstrap_indices = torch.randint(len(loader.dataset), (self.num_bootstraps, num_samples))
+        sampler = _FixedSampler(self._bootstrap_indices[0].tolist())
+        loader_kwargs = dict(num_workers=loader.num_workers, collate_fn=loader.collate_fn,
+                             pin_memory=loader.pin_memory or self.device.type == 'cuda')
+        if getattr(loader, 'persistent_workers', False):
+            loader_kwargs.update(persistent_workers=True, prefetch_factor=loader.prefetch_factor)
+        self.data_loader = DataLoader(loader.dataset, batch_size=batch_size, sampler=sampler, **loader_kwargs)
+
+    def _device_batches(self) -> Iterator:
         """
-        if not (isinstance(self.data_loader.sampler, RandomSampler)
-                or isinstance(self.data_loader.batch_sampler, RandomSampler)):
-            raise Exception("No random sampler in dataloader.")
+        Returns an iterator over one pass of the data loader with the batches on the evaluation device,
+        prefetched on a side stream if the device is a gpu.
+
+        Returns: batch iterator
+
+        """
+        if self.device.type == 'cuda':
+            stream = torch.cuda.current_stream()
+            if stream not in self._staging_buffers:
+                self._staging_buffers[stream] = _StagingBuffers(self.device)
+            return _CUDAPrefetcher(iter(self.data_loader), self._staging_buffers[stream].to_device)
+        return (self._recursive_to_cuda(batch) for batch in self.data_loader)
 
     def _bootstrap_step(self, mean_dict: dict) -> None:
         """
@@ -65,19 +270,26 @@ class ModelEvaluator:
             mean_dict: dictionary of means
 
         """
-        torch.no_grad()
-        running_metrics = {metric.__name__: [] for metric in self.metrics}
+        self.data_loader.sampler.indices = self._bootstrap_indices[self._current_bootstrap_step].tolist()
+        # running (count, mean) per metric
+        running_metrics = {name: [0, 0.0] for name, _, _ in self._metric_specs}
+
+        # bind the names used for every batch to locals
+        model = self._forward
+        compute_running_metrics = self._compute_running_metrics
+        device, autocast_dtype = self.device, self._autocast_dtype
 
-        for sample_step in range(self.bootstrap_size):
-            batch_x, batch_y, input_lengths, target_lengths = next(iter(self.data_loader))
+        # inference_mode (torch >= 1.9) also skips the version counter and view tracking of no_grad
+        with getattr(torch, 'inference_mode', torch.no_grad)():
+            for batch in self._device_batches():  # on GPU
+                batch_x, batch_y, input_lengths, target_lengths = batch
 
-            batch = (batch_x, batch_y, input_lengths, target_lengths)
-            batch = self._recursive_to_cuda(batch)  # move to GPU
-            batch_x, batch_y, input_lengths, target_lengths = batch
+                with autocast(device, autocast_dtype):
+                    model_output = model(batch_x, input_lengths)
 
-            model_output = self.model(batch_x, input_lengths)
+                compute_running_metrics(model_output, batch, running_metrics)
 
-            self._compute_running_metrics(model_output, batch, running_metrics)
+            self._compute_deferred_metrics(running_metrics)
 
         self._fill_mean_dict(running_metrics, mean_dict)
 
@@ -86,36 +298,89 @@ class ModelEvaluator:
                                  batch: Tuple[torch.Tensor, torch.Tensor],
                                  running_metrics: dict) -> None:
         """
-        Computes all metrics based on predictions and batches and adds them to the metrics
-        dictionary. Allows to prepend a prefix to the metric names in the dictionary.
+        Computes all metrics based on predictions and batches and updates their running means
+        in the metrics dictionary.
 
         Args:
             model_output: model output tensor
             batch: training batch
-            running_metrics: running metrics dictionary
+            running_metrics: running metrics dictionary, maps metric names to [count, mean], means of tensor
+                             metrics are float64 tensors
 
         """
-        for metric in self.metrics:
-            if metric.__name__ == 'word_error_rate' or metric.__name__ == 'character_error_rate':
-                metric_result = metric(model_output, batch, self.decoder)
+        decoder = self.decoder
+        is_tensor = torch.is_tensor
+        defer_decoding = self._defer_decoding
+        for name, metric, needs_decoder in self._metric_specs:
+            if needs_decoder:
+                if defer_decoding:
+                    continue
+                metric_result = metric(model_output, batch, decoder)
             else:
                 metric_result = metric(model_output, batch)
-            if type(metric_result) == torch.Tensor:
-                metric_result = metric_result.item()
+            if is_tensor(metric_result):
+                # keep the result on the device, calling .item() here would sync with the gpu for every batch.
+                # Accumulate in float64, in a low precision dtype the small updates of the mean would round away
+                metric_result = metric_result.detach().double()
+
+            # incremental (Welford) mean, works for floats and for scalar tensors alike
+            running_metric = running_metrics[name]
+            running_metric[0] += 1
+            running_metric[1] = running_metric[1] + (metric_result - running_metric[1]) / running_metric[0]
+
+        if defer_decoding:
+            out, output_sizes = model_output
+            inputs, targets, input_percentages, target_sizes = batch
+            # the batch tensors live in reused staging buffers and the outputs of a compiled model
+            # are overwritten by its next replay, keep copies of them
+            out = out.detach().clone() if self.compile_model else out.detach()
+            self._deferred_outputs.append((out, output_sizes.clone(), targets.clone(), target_sizes.clone()))
+            if len(self._deferred_outputs) >= self.decoder_metric_batches:
+                self._compute_deferred_metrics(running_metrics)
+
+    def _compute_deferred_metrics(self, running_metrics: dict) -> None:
+        """
+        Computes the decoder based metrics for all deferred batches with a single decoder call
+        and updates their running means in the metrics dictionary.
 
-            running_metrics[metric.__name__].append(metric_result)
+        Args:
+            running_metrics: running metrics dictionary, maps metric names to [count, mean]
+
+        """
+        if not self._defer_decoding or len(self._deferred_outputs) == 0:
+            return
+        num_batches = len(self._deferred_outputs)
+        outs, output_sizes, targets, target_sizes = zip(*self._deferred_outputs)
+        self._deferred_outputs = []
+        # pad the outputs to the longest sequence, the decoder ignores everything after output_sizes
+        max_length = max(out.size(1) for out in outs)
+        out = torch.cat([F.pad(out, (0, 0, 0, max_length - out.size(1))) for out in outs])
+        model_output = (out, torch.cat(output_sizes))
+        batch = (None, torch.cat(targets), None, torch.cat(target_sizes))
+
+        for name, metric, needs_decoder in self._metric_specs:
+            if not needs_decoder:
+                continue
+            metric_result = metric(model_output, batch, self.decoder)
+            if torch.is_tensor(metric_result):
+                metric_result = metric_result.detach().double()
+            # the result is the mean over num_batches equally sized batches, weight it accordingly
+            running_metric = running_metrics[name]
+            running_metric[0] += num_batches
+            running_metric[1] = running_metric[1] + \
+                (metric_result - running_metric[1]) * num_batches / running_metric[0]
 
     def _fill_mean_dict(self, running_metrics: Dict, mean_dict: Dict) -> None:
         """
-        Calculates the mean and saves it in a dictionary.
+        Saves the mean of each metric in a dictionary. Means of tensor metrics stay on the device,
+        so that the bootstrap does not have to wait for the gpu.
 
         Args:
-            running_metrics: running metrics dictionary
+            running_metrics: running metrics dictionary, maps metric names to [count, mean]
             mean_dict: mean dictionary
 
         """
-        for key, value in running_metrics.items():
-            mean = np.mean(value)
+        for key, (_, mean) in running_metrics.items():
             mean_dict[key].append(mean)
 
     def _compute_mean_variance(self, mean_dict: Dict) -> None:
@@ -123,15 +388,23 @@ class ModelEvaluator:
         Compute mean and variance of each list in the dictionary.
 
         Args:
-            mean_dict: mean dictionary
+            mean_dict: mean dictionary, values are lists of floats or of scalar tensors
 
         """
-        self.eval_dict = defaultdict()
+        self.eval_dict = {}
         for key, value in mean_dict.items():
-            tmp_mean = np.mean(value)
-            tmp_variance =np.var(value)
-            self.eval_dict[key + '_mean'] = tmp_mean
-            self.eval_dict[key + '_variance'] = tmp_variance
+            if len(value) > 0 and torch.is_tensor(value[0]):
+                # a single transfer per metric for all bootstraps
+                bootstrap_means = torch.stack(value).to(device='cpu', dtype=torch.float64).numpy()
+            else:
+                bootstrap_means = np.fromiter(value, dtype=np.float64, count=len(value))
+            self.eval_dict[key + '_mean'] = float(bootstrap_means.mean())
+            # unbiased estimate of the variance over the bootstraps, it is undefined (NaN, which is not valid
+            # json) for a single bootstrap, report 0 as the former population variance did
+            if len(bootstrap_means) < 2:
+                self.eval_dict[key + '_variance'] = 0.0
+            else:
+                self.eval_dict[key + '_variance'] = float(bootstrap_means.var(ddof=1))
 
     def set_metrics(self, metrics: List[Callable]) -> None:
         """
@@ -143,6 +416,7 @@ class ModelEvaluator:
 
         """
         self.metrics = metrics
+        self._update_metric_specs()
 
     def add_metric(self, metric: Callable):
         """
@@ -153,6 +427,29 @@ class ModelEvaluator:
 
         """
         self.metrics.append(metric)
+        self._update_metric_specs()
+
+    def _update_metric_specs(self) -> None:
+        """
+        Precomputes how the metrics are called and whether the decoding is deferred, so that this is not
+        looked up for every batch.
+        """
+        self._metric_specs = [self._metric_spec(metric) for metric in self.metrics]
+        self._defer_decoding = self.decoder_metric_batches > 1 and \
+            any(needs_decoder for _, _, needs_decoder in self._metric_specs)
+
+    @staticmethod
+    def _metric_spec(metric: Callable) -> Tuple[str, Callable, bool]:
+        """
+        Precomputes how a metric is called, so that this is not looked up for every batch.
+
+        Args:
+            metric: metric function
+
+        Returns: name of the metric, metric function, whether the metric needs the decoder
+
+        """
+        return metric.__name__, metric, metric.__name__ in DECODER_METRICS
 
     def start_evaluation(self, tb_path: str = None, log_path: str = None) -> None:
         """
@@ -165,11 +462,29 @@ class ModelEvaluator:
         """
         LOGGER.info(f'Start Evaluation')
         self.model.eval() #evaluation mode
-        mean_dict = {metric.__name__: [] for metric in self.metrics}
+        # list of bootstrap means per metric
+        mean_dict = defaultdict(list)
+
+        streams = []
+        if self.device.type == 'cuda':
+            # the bootstraps are independent, queue them on several streams so that they overlap on the gpu.
+            # A compiled model replays a CUDA graph that writes its outputs to the same memory every time,
+            # without ordering between the streams a replay could overwrite outputs another bootstrap still reads
+            num_streams = 1 if self.compile_model else min(self.num_bootstraps, MAX_BOOTSTRAP_STREAMS)
+            streams = [torch.cuda.Stream() for _ in range(num_streams)]
+            for stream in streams:
+                stream.wait_stream(torch.cuda.current_stream())
 
         for bootstrap_step in range(self.num_bootstraps):
             self._current_bootstrap_step = bootstrap_step
-            self._bootstrap_step(mean_dict)
+            if streams:
+                stream_context = torch.cuda.stream(streams[bootstrap_step % len(streams)])
+            else:
+                stream_context = contextlib.suppress()  # no-op context
+            with stream_context:
+                self._bootstrap_step(mean_dict)
+        if streams:
+            torch.cuda.synchronize()
         self._compute_mean_variance(mean_dict)
         self._evaluation_done = True
         if tb_path is not None:
@@ -191,7 +506,7 @@ class ModelEvaluator:
         file_to_dump = os.path.join(output_path, 'evaluation.json')
         LOGGER.info(f'dump evaluation results to {file_to_dump}')
         with open(file_to_dump, 'w') as fp:
-            json.dump(self.eval_dict, fp)
+            json.dump(self.eval_dict, fp, separators=(',', ':'))
 
     def dump_to_tensorboard(self, log_path: str) -> None:
         """
@@ -202,32 +517,28 @@ class ModelEvaluator:
 
         """
         LOGGER.info(f'Log evaluations in tensorboard.')
-        writer = SummaryWriter(log_dir=log_path)
-        for key, value in self.eval_dict:
-            writer.add_scalar(key, value)
+        # the events are buffered and written once when the writer is closed
+        with SummaryWriter(log_dir=log_path) as writer:
+            for key, value in self.eval_dict.items():
+                writer.add_scalar(key, value, global_step=0)
 
     def _recursive_to_cuda(self, tensors: Union[Tuple[torch.Tensor], torch.Tensor]) \
-            -> Union[List[torch.Tensor], torch.Tensor]:
+            -> Union[Tuple[torch.Tensor], List[torch.Tensor], torch.Tensor]:
         """
         Recursively iterates nested lists in depth-first order and transfers all tensors
-        to specified cuda device.
+        to the evaluation device. The copies are asynchronous if the tensors are in pinned memory.
 
         Args:
             tensors (list or Tensor): list of tensors or tensor tuples, can be nested
 
-        Returns: list of cuda tensors if cuda is enabled.
+        Returns: the same structure with the tensors on the evaluation device, other objects are kept as they are.
 
         """
-        if self.device is None:  # keep on cpu
-            return tensors
-
-        if type(tensors) != list and type(tensors) != tuple:  # not only for torch.Tensor
-            return tensors.to(device=self.device)
-
-        cuda_tensors = list()
-        for i in range(len(tensors)):
-            cuda_tensors.append(self._recursive_to_cuda(tensors[i]))
-        return cuda_tensors
+        if torch.is_tensor(tensors):
+            return tensors.to(self.device, non_blocking=True)
+        if isinstance(tensors, (list, tuple)):
+            return type(tensors)(self._recursive_to_cuda(tensor) for tensor in tensors)
+        return tensors
 
 
 
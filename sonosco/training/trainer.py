@@ -10,6 +10,7 @@ from torch.utils.data import DataLoader
 from .abstract_callback import AbstractCallback
 from sonosco.serialization import serializable
 from sonosco.decoders.decoder import Decoder
+from sonosco.common.torch_utils import resolve_autocast_dtype, autocast
 
 LOGGER = logging.getLogger(__name__)
 
@@ -33,6 +34,9 @@ class ModelTrainer:
         custom_model_eval (boolean, optional): enables training mode where the model is evaluated in the loss function
         gpu (int, optional): if not set training runs on cpu, otherwise an int is expected that determines the training gpu
         clip_grads (float, optional): if set training gradients will be clipped at specified norm
+        autocast_dtype (str, optional): 'bfloat16' or 'float16', if set the loss is computed in mixed precision
+                                        with torch.autocast on gpus that support it, float16 gradients are scaled
+                                        with a GradScaler
     """
     model: torch.nn.Module
     loss: Union[Callable[[Any, Any], Any],
@@ -52,6 +56,7 @@ class ModelTrainer:
     _current_epoch: int = 0
     test_step: int = 50
     weight_decay: int = 50
+    autocast_dtype: str = None
 
     def __post_init__(self) -> None:
         """
@@ -60,6 +65,15 @@ class ModelTrainer:
         self.optimizer = self.optimizer_class(self.model.parameters(), lr=self.lr, weight_decay=self.weight_decay)
         self._stop_training = False  # used stop training externally
         self.performance_measures = dict()
+        self._autocast_dtype = resolve_autocast_dtype(self.autocast_dtype, self.device)
+        # float16 has a narrow range, the loss is scaled to keep small gradients from underflowing
+        self._grad_scaler = torch.cuda.amp.GradScaler() if self._autocast_dtype == torch.float16 else None
+
+    def _autocast(self):
+        """
+        Context in which the model and loss are evaluated, autocast if mixed precision is enabled.
+        """
+        return autocast(self.device, self._autocast_dtype)
 
     def set_metrics(self, metrics: List[Callable]) -> None:
         """
@@ -105,15 +119,17 @@ class ModelTrainer:
         Start model training.
         """
         self.model.train()  # train mode
-        for epoch in range(1, self.epochs + 1):
-            self._epoch_step(epoch)
+        try:
+            for epoch in range(1, self.epochs + 1):
+                self._epoch_step(epoch)
 
-            self._current_epoch += 1
+                self._current_epoch += 1
 
-            if self._stop_training:
-                break
-
-        self._close_callbacks()
+                if self._stop_training:
+                    break
+        finally:
+            # also close the callbacks if training is interrupted (e.g. KeyboardInterrupt)
+            self._close_callbacks()
 
     def stop_training(self) -> None:
         """
@@ -127,14 +143,17 @@ class ModelTrainer:
         """
         self.model.train()
 
-        for epoch in range(self._current_epoch, self.epochs + 1):
-            self._epoch_step(epoch)
+        try:
+            for epoch in range(self._current_epoch, self.epochs + 1):
+                self._epoch_step(epoch)
 
-            self._current_epoch += 1
+                self._current_epoch += 1
 
-            if self._stop_training:
-                break
-        self._close_callbacks()
+                if self._stop_training:
+                    break
+        finally:
+            # also close the callbacks if training is interrupted (e.g. KeyboardInterrupt)
+            self._close_callbacks()
 
     def _epoch_step(self, epoch: int) -> None:
         """
@@ -193,14 +212,19 @@ class ModelTrainer:
         # evaluate loss
         batch_x, batch_y, input_lengths, target_lengths = batch
 
-        if self.custom_model_eval:
-            loss, model_output = self.loss(batch, self.model)
-        else:
-            model_output = self.model(batch_x, input_lengths)
-            loss = self.loss(model_output, batch_y)
+        with self._autocast():
+            if self.custom_model_eval:
+                loss, model_output = self.loss(batch, self.model)
+            else:
+                model_output = self.model(batch_x, input_lengths)
+                loss = self.loss(model_output, batch_y)
 
         self.optimizer.zero_grad()  # reset gradients
-        loss.backward()  # backpropagation
+        if self._grad_scaler is not None:
+            self._grad_scaler.scale(loss).backward()  # backpropagation of the scaled loss
+            self._grad_scaler.unscale_(self.optimizer)  # clip and measure the true gradients
+        else:
+            loss.backward()  # backpropagation
 
         # gradient clipping
         if self.clip_grads is not None:
@@ -208,7 +232,11 @@ class ModelTrainer:
 
         grad_norm = self._comp_gradients()  # compute average gradient norm
 
-        self.optimizer.step()  # apply optimization step
+        if self._grad_scaler is not None:
+            self._grad_scaler.step(self.optimizer)  # skips the step if gradients overflowed
+            self._grad_scaler.update()
+        else:
+            self.optimizer.step()  # apply optimization step
         return loss, model_output, grad_norm
 
     def _compute_validation_error(self, running_metrics: Dict) -> None:
@@ -226,11 +254,12 @@ class ModelTrainer:
 
             # evaluate loss
             batch_x, batch_y, input_lengths, target_lengths = batch
-            if self.custom_model_eval:  # e.g. used for sequences and other complex model evaluations
-                val_loss, model_output = self.loss(batch, self.model)
-            else:
-                model_output = self.model(batch_x)
-                val_loss = self.loss(model_output, batch_y)
+            with self._autocast():
+                if self.custom_model_eval:  # e.g. used for sequences and other complex model evaluations
+                    val_loss, model_output = self.loss(batch, self.model)
+                else:
+                    model_output = self.model(batch_x)
+                    val_loss = self.loss(model_output, batch_y)
 
             # compute running validation loss and metrics. add 'val_' prefix to all measures.
             running_val_loss += val_loss.item()
@@ -351,7 +380,8 @@ class ModelTrainer:
             return tensors
 
         if type(tensors) != list and type(tensors) != tuple:  # not only for torch.Tensor
-            return tensors.to(device=self.device, non_blocking=False)
+            # batches come from pinned memory, the copy does not have to block the host
+            return tensors.to(device=self.device, non_blocking=True)
 
         cuda_tensors = list()
         for i in range(len(tensors)):
@@ -0,0 +1,142 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn as nn
+
+from torch.utils.data import DataLoader
+from sonosco.decoders import GreedyDecoder
+from sonosco.training import ModelEvaluator
+from sonosco.training.metrics import word_error_rate, character_error_rate
+
+LABELS = "_AB C"
+
+
+class IdentityModel(nn.Module):
+    """
+    Returns its input and records the size of every batch it is called with.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def forward(self, batch_x, input_lengths):
+        self.batch_sizes.append(batch_x.size(0))
+        return batch_x
+
+
+class OutputModel(nn.Module):
+    """
+    The inputs are the outputs (N x T x C), returns them with their lengths as a CTC model does.
+    """
+
+    def forward(self, batch_x, input_lengths):
+        return batch_x, input_lengths
+
+
+def collate_fn(samples):
+    inputs, targets, input_lengths, target_lengths = zip(*samples)
+    batch_x = nn.utils.rnn.pad_sequence(inputs, batch_first=True)
+    return batch_x, torch.cat(targets), torch.stack(input_lengths), torch.stack(target_lengths)
+
+
+def index_dataset(size):
+    # the input of a sample is its index
+    return [(torch.tensor([float(i)]), torch.tensor([1]), torch.tensor(1), torch.tensor(1)) for i in range(size)]
+
+
+def transcription_dataset(size):
+    samples = []
+    for _ in range(size):
+        output_length, target_length = torch.randint(3, 9, (2,)).tolist()
+        samples.append((torch.randn(output_length, len(LABELS)), torch.randint(1, len(LABELS), (target_length,)),
+                        torch.tensor(output_length), torch.tensor(target_length)))
+    return samples
+
+
+def batch_mean(model_output, batch):
+    return model_output.mean()
+
+
+def batch_max(model_output, batch):
+    return float(model_output.max())
+
+
+def batch_max_output(model_output, batch):
+    out, output_sizes = model_output
+    return float(out.max())
+
+
+def test_evaluator_bootstrap_mean_and_variance():
+    torch.manual_seed(0)
+    batch_size, bootstrap_size, num_bootstraps = 4, 3, 5
+    loader = DataLoader(index_dataset(50), batch_size=batch_size, collate_fn=collate_fn)
+    evaluator = ModelEvaluator(IdentityModel(), loader, bootstrap_size=bootstrap_size,
+                               num_bootstraps=num_bootstraps, metrics=[batch_mean, batch_max])
+
+    evaluator.start_evaluation()
+
+    # the samples of a bootstrap are its indices, split into bootstrap_size batches
+    bootstraps = evaluator._bootstrap_indices.double().numpy().reshape(num_bootstraps, bootstrap_size, batch_size)
+    for name, reference in (('batch_mean', bootstraps.mean(axis=2)), ('batch_max', bootstraps.max(axis=2))):
+        bootstrap_means = reference.mean(axis=1)
+        assert evaluator.eval_dict[name + '_mean'] == pytest.approx(bootstrap_means.mean())
+        assert evaluator.eval_dict[name + '_variance'] == pytest.approx(np.var(bootstrap_means, ddof=1))
+
+
+def test_evaluator_single_bootstrap_has_zero_variance():
+    torch.manual_seed(0)
+    loader = DataLoader(index_dataset(10), batch_size=2, collate_fn=collate_fn)
+    evaluator = ModelEvaluator(IdentityModel(), loader, bootstrap_size=2, num_bootstraps=1, metrics=[batch_mean])
+
+    evaluator.start_evaluation()
+
+    assert evaluator.eval_dict['batch_mean_variance'] == 0.0
+
+
+@pytest.mark.parametrize("eval_batch_size, expected_batch_sizes", [(None, [4, 4, 4]), (6, [6, 6]), (5, [5, 5, 5])])
+def test_evaluator_eval_batch_size(eval_batch_size, expected_batch_sizes):
+    torch.manual_seed(0)
+    model = IdentityModel()
+    loader = DataLoader(index_dataset(50), batch_size=4, collate_fn=collate_fn)
+    evaluator = ModelEvaluator(model, loader, bootstrap_size=3, num_bootstraps=2, metrics=[batch_mean],
+                               eval_batch_size=eval_batch_size)
+
+    evaluator.start_evaluation()
+
+    # a bootstrap keeps its 12 samples, rounded up to a multiple of eval_batch_size
+    assert evaluator._bootstrap_indices.shape == (2, sum(expected_batch_sizes))
+    assert model.batch_sizes == expected_batch_sizes * 2
+
+
+@pytest.mark.parametrize("decoder_metric_batches", [2, 3, 10])
+def test_evaluator_deferred_decoding_matches_per_batch_decoding(decoder_metric_batches):
+    torch.manual_seed(0)
+    dataset = transcription_dataset(40)
+    metrics = [word_error_rate, character_error_rate, batch_max_output]
+    results = []
+    for metric_batches in (1, decoder_metric_batches):
+        # both evaluators draw the same bootstraps
+        torch.manual_seed(1)
+        loader = DataLoader(dataset, batch_size=3, collate_fn=collate_fn)
+        evaluator = ModelEvaluator(OutputModel(), loader, bootstrap_size=4, num_bootstraps=3,
+                                   decoder=GreedyDecoder(LABELS), metrics=list(metrics),
+                                   decoder_metric_batches=metric_batches)
+        evaluator.start_evaluation()
+        results.append(evaluator.eval_dict)
+
+    per_batch, deferred = results
+    assert deferred.keys() == per_batch.keys()
+    for key, value in per_batch.items():
+        assert deferred[key] == pytest.approx(value)
+
+
+def test_evaluator_does_not_defer_without_decoder_metrics():
+    torch.manual_seed(0)
+    loader = DataLoader(transcription_dataset(10), batch_size=2, collate_fn=collate_fn)
+    evaluator = ModelEvaluator(OutputModel(), loader, bootstrap_size=2, num_bootstraps=2,
+                               metrics=[batch_max_output], decoder_metric_batches=4)
+    assert not evaluator._defer_decoding
+
+    evaluator.add_metric(word_error_rate)
+    assert evaluator._defer_decoding
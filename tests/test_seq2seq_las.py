@@ -0,0 +1,149 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from sonosco.models.seq2seq_las import Seq2Seq, Decoder, IGNORE_ID
+
+VOCAB_SIZE = 7
+EMBEDDING_DIM = 5
+HIDDEN_SIZE = 6
+NUM_LAYERS = 2
+SOS_ID = 5
+EOS_ID = 6
+
+
+class ReferenceDecoder(nn.Module):
+    """
+    The LAS decoder as it was implemented with a stack of LSTMCells, stepping every utterance
+    and every beam hypothesis separately. The optimized Decoder has to produce the same results.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.embedding = nn.Embedding(VOCAB_SIZE, EMBEDDING_DIM)
+        self.rnn = nn.ModuleList([nn.LSTMCell(EMBEDDING_DIM + HIDDEN_SIZE, HIDDEN_SIZE)] +
+                                 [nn.LSTMCell(HIDDEN_SIZE, HIDDEN_SIZE) for _ in range(1, NUM_LAYERS)])
+        self.mlp = nn.Sequential(nn.Linear(2 * HIDDEN_SIZE, HIDDEN_SIZE),
+                                 nn.Tanh(),
+                                 nn.Linear(HIDDEN_SIZE, VOCAB_SIZE))
+
+    def step(self, y, att_c, h_list, c_list, encoder_padded_outputs):
+        rnn_input = torch.cat((self.embedding(y), att_c), dim=1)
+        h_list, c_list = list(h_list), list(c_list)
+        h_list[0], c_list[0] = self.rnn[0](rnn_input, (h_list[0], c_list[0]))
+        for l in range(1, NUM_LAYERS):
+            h_list[l], c_list[l] = self.rnn[l](h_list[l - 1], (h_list[l], c_list[l]))
+        rnn_output = h_list[-1]
+        attention_scores = torch.bmm(rnn_output.unsqueeze(dim=1), encoder_padded_outputs.transpose(1, 2))
+        att_c = torch.bmm(F.softmax(attention_scores, dim=2), encoder_padded_outputs).squeeze(dim=1)
+        predicted_y_t = self.mlp(torch.cat((rnn_output, att_c), dim=1))
+        return predicted_y_t, att_c, h_list, c_list
+
+    def zero_state(self, encoder_padded_outputs):
+        N = encoder_padded_outputs.size(0)
+        h_list = [encoder_padded_outputs.new_zeros(N, HIDDEN_SIZE) for _ in range(NUM_LAYERS)]
+        c_list = [encoder_padded_outputs.new_zeros(N, HIDDEN_SIZE) for _ in range(NUM_LAYERS)]
+        return encoder_padded_outputs.new_zeros(N, HIDDEN_SIZE), h_list, c_list
+
+    def forward(self, ys, encoder_padded_outputs):
+        sos, eos = ys[0].new([SOS_ID]), ys[0].new([EOS_ID])
+        ys_in = [torch.cat([sos, y]) for y in ys]
+        ys_out = [torch.cat([y, eos]) for y in ys]
+        ys_in_pad = nn.utils.rnn.pad_sequence(ys_in, batch_first=True, padding_value=EOS_ID)
+        ys_out_pad = nn.utils.rnn.pad_sequence(ys_out, batch_first=True, padding_value=IGNORE_ID)
+        att_c, h_list, c_list = self.zero_state(encoder_padded_outputs)
+        y_all = []
+        for t in range(ys_in_pad.size(1)):
+            predicted_y_t, att_c, h_list, c_list = self.step(ys_in_pad[:, t], att_c, h_list, c_list,
+                                                             encoder_padded_outputs)
+            y_all.append(predicted_y_t)
+        y_all = torch.stack(y_all, dim=1)
+        ce_loss = F.cross_entropy(y_all.view(-1, VOCAB_SIZE), ys_out_pad.view(-1), ignore_index=IGNORE_ID)
+        return y_all, [y.size(0) for y in ys_in], ce_loss
+
+    def recognize_beam(self, encoder_outputs, beam, nbest, maxlen):
+        encoder_outputs = encoder_outputs.unsqueeze(0)
+        att_c, h_list, c_list = self.zero_state(encoder_outputs)
+        hyps = [{'score': 0.0, 'yseq': [SOS_ID], 'h_prev': h_list, 'c_prev': c_list, 'a_prev': att_c}]
+        ended_hyps = []
+        for i in range(maxlen):
+            hyps_best_kept = []
+            for hyp in hyps:
+                y = encoder_outputs.new_full((1,), hyp['yseq'][i], dtype=torch.long)
+                predicted_y_t, att_c, h_list, c_list = self.step(y, hyp['a_prev'], hyp['h_prev'],
+                                                                 hyp['c_prev'], encoder_outputs)
+                local_best_scores, local_best_ids = torch.topk(F.log_softmax(predicted_y_t, dim=1), beam, dim=1)
+                for j in range(beam):
+                    hyps_best_kept.append({'score': hyp['score'] + float(local_best_scores[0, j]),
+                                           'yseq': hyp['yseq'] + [int(local_best_ids[0, j])],
+                                           'h_prev': h_list, 'c_prev': c_list, 'a_prev': att_c})
+            hyps = sorted(hyps_best_kept, key=lambda x: x['score'], reverse=True)[:beam]
+            # add eos in the final loop to avoid that there are no ended hyps
+            if i == maxlen - 1:
+                for hyp in hyps:
+                    hyp['yseq'].append(EOS_ID)
+            ended_hyps += [hyp for hyp in hyps if hyp['yseq'][-1] == EOS_ID]
+            hyps = [hyp for hyp in hyps if hyp['yseq'][-1] != EOS_ID]
+        return sorted(ended_hyps, key=lambda x: x['score'], reverse=True)[:nbest]
+
+
+@pytest.fixture
+def decoders():
+    torch.manual_seed(0)
+    reference = ReferenceDecoder()
+    decoder = Decoder(vocab_size=VOCAB_SIZE, embedding_dim=EMBEDDING_DIM, sos_id=SOS_ID, eos_id=EOS_ID,
+                      hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS)
+    # the state dict of the reference has the LSTMCell layout (rnn.<l>.<name>)
+    decoder.load_state_dict(reference.state_dict())
+    return reference, decoder
+
+
+@pytest.mark.parametrize("gradient_checkpointing", [False, True])
+def test_las_decoder_forward_matches_reference(decoders, gradient_checkpointing):
+    reference, decoder = decoders
+    decoder.gradient_checkpointing = gradient_checkpointing
+    ys = [torch.tensor([1, 2, 3, 4]), torch.tensor([2]), torch.tensor([4, 1, 0])]
+    encoder_padded_outputs = torch.randn(len(ys), 9, HIDDEN_SIZE)
+
+    expected_out, expected_lens, expected_loss = reference(ys, encoder_padded_outputs)
+    model_out, y_lens, ce_loss = decoder(ys, encoder_padded_outputs)
+
+    assert torch.allclose(model_out, expected_out, atol=1e-5)
+    assert y_lens.tolist() == expected_lens
+    assert torch.allclose(ce_loss, expected_loss, atol=1e-5)
+
+
+@pytest.mark.parametrize("maxlen", [1, 4, 8])
+def test_las_decoder_beam_search_matches_reference(decoders, maxlen):
+    reference, decoder = decoders
+    decoder.eval()
+    encoder_outputs = torch.randn(9, HIDDEN_SIZE)
+    args = {'beam_size': 3, 'nbest': 3, 'decode_max_len': maxlen}
+
+    with torch.no_grad():
+        expected = reference.recognize_beam(encoder_outputs, beam=3, nbest=3, maxlen=maxlen)
+        nbest_hyps = decoder.recognize_beam(encoder_outputs, None, args)
+
+    assert [hyp['yseq'] for hyp in nbest_hyps] == [hyp['yseq'] for hyp in expected]
+    assert [hyp['score'] for hyp in nbest_hyps] == pytest.approx([hyp['score'] for hyp in expected], abs=1e-5)
+
+
+def test_quantized_seq2seq_recognize():
+    torch.manual_seed(0)
+    model = Seq2Seq(encoder_args=dict(input_size=4, hidden_size=HIDDEN_SIZE // 2, num_layers=2),
+                    decoder_args=dict(vocab_size=VOCAB_SIZE, embedding_dim=EMBEDDING_DIM, sos_id=SOS_ID,
+                                      eos_id=EOS_ID, hidden_size=HIDDEN_SIZE, num_layers=NUM_LAYERS))
+    model.eval()
+    quantized = model.quantize_for_inference()
+    args = {'beam_size': 3, 'nbest': 2, 'decode_max_len': 5}
+
+    with torch.no_grad():
+        nbest_hyps = quantized.recognize(torch.randn(9, 4), torch.tensor([9]), None, args)
+
+    assert isinstance(model.encoder.rnn, nn.LSTM)
+    assert not isinstance(quantized.encoder.rnn, nn.LSTM)
+    assert len(nbest_hyps) == 2
+    for hyp in nbest_hyps:
+        assert hyp['yseq'][0] == SOS_ID and hyp['yseq'][-1] == EOS_ID
+        assert len(hyp['yseq']) <= args['decode_max_len'] + 2